@@ -1,7 +1,13 @@
 import os
-import json
+import re
+import asyncio
+import orjson
+import time
+import hashlib
+import functools
 import logging
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -14,11 +20,8 @@ from telegram.ext import (
 from database import Database
 from gcalendar import GoogleCalendar
 from gmail import GmailService
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
+from aiohttp import web
+import google.generativeai as genai
 
 # Configurazione logging
 logging.basicConfig(
@@ -45,202 +48,319 @@ logging.root.handlers = [handler]
 
 logger = logging.getLogger(__name__)
 
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'OK')
+# Schema imposto all'output di Gemini (response_schema): la risposta è sempre JSON valido
+ACTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "action": {"type": "STRING", "format": "enum", "enum": ["add", "delete", "modify", "list"]},
+        "summary": {"type": "STRING"},
+        "start": {"type": "STRING"},
+        "end": {"type": "STRING"},
+        "event_id": {"type": "STRING"},
+        "date": {"type": "STRING"},
+        "time": {"type": "STRING"},
+    },
+    "required": ["action"],
+}
 
-class HealthServer:
-    def __init__(self, port=10000):
-        self.port = port
-        self.server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-        self.thread = Thread(target=self.server.serve_forever)
+# Comandi banali riconosciuti senza chiamare l'LLM
+_LIST_RE = re.compile(r"^\s*(mostra|elenca|lista|visualizza|dammi|quali).*eventi?\s*$", re.I)
+_START_RE = re.compile(r"^\s*/?start\s*$", re.I)
 
-    def start(self):
-        self.thread.start()
-        logger.info(f"Health check server avviato su porta {self.port}")
+HEALTH_PORT = 10000
 
-    def stop(self):
-        self.server.shutdown()
-        self.thread.join()
-        logger.info("Health check server fermato")
+# Massimo di chiamate a Gemini in contemporanea (limite di rate del modello)
+LLM_CONCURRENCY = 16
+
+TIMEZONE = ZoneInfo("Europe/Rome")
+
+# Riferimenti temporali relativi: l'interpretazione dipende dal giorno corrente
+RELATIVE_TIME_TOKENS = {
+    "oggi", "domani", "dopodomani", "ieri", "stasera", "stamattina", "stanotte",
+    "prossimo", "prossima", "settimana", "weekend",
+    "lunedì", "martedì", "mercoledì", "giovedì", "venerdì", "sabato", "domenica",
+}
+
+# Parte statica del prompt: deve restare identica byte per byte a ogni chiamata
+# perché Gemini possa riutilizzare il prefisso in cache. Le parti variabili vanno
+# solo in DYNAMIC_SUFFIX. Il segnaposto AAAA per l'anno è spiegato nel prompt stesso.
+STATIC_PROMPT = """
+Analizza il comando utente e genera un JSON strutturato.
+Considera questi sinonimi:
+- Creazione: aggiungi, crea, nuovo, inserisci, programma
+- Eliminazione: cancella, elimina, rimuovi, annulla
+- Modifica: modifica, cambia, aggiorna, sposta, riprogramma, rinvia
+- Lista: mostra, elenca, lista, visualizza, vedi, dammi, quali
+
+Linee guida critiche:
+1. Il campo 'summary' DEVE contenere SOLO il titolo base dell'evento
+2. Rimuovi ASSOLUTAMENTE riferimenti temporali dal 'summary' (es. "delle 15", "del 12 marzo")
+3. Per 'modify'/'delete' senza event_id:
+   - 'date' e 'time' devono sempre riflettere la data/ora ORIGINALE
+   - Usa il formato ISO8601 per tutti i campi temporali
+4. Per le azioni di modifica, includi SEMPRE sia i nuovi orari (start/end) che quelli originali (date/time)
+
+Struttura JSON:
+{{
+    "action": "add|delete|modify|list",
+    "summary": "stringa",             // SOLO titolo, senza date/orari
+    "start": "AAAA-MM-DDTHH:MM:SS",   // Obbligatorio per add/modify (NUOVO orario)
+    "end": "AAAA-MM-DDTHH:MM:SS",     // Obbligatorio per add/modify (NUOVO orario)
+    "event_id": "stringa",            // Obbligatorio solo se specificato
+    "date": "AAAA-MM-DD",             // Obbligatorio per delete/modify senza event_id (DATA ORIGINALE)
+    "time": "HH:MM"                   // Obbligatorio per delete/modify senza event_id (ORA ORIGINALE)
+}}
+
+Istruzioni:
+1. Per le date relative (es. "domani", "lunedì prossimo") usa la data assoluta
+2. Per gli orari: "alle 15" -> 15:00:00, "16:30" -> 16:30:00
+3. Se mancano informazioni critiche, deducile dal contesto
+4. IMPORTANTE: Se non vieve specificato l'anno usa sempre l'anno corrente (indicato in fondo come "Anno corrente") per tutte le date.
+   Nella struttura e negli esempi AAAA sta per l'anno corrente indicato in fondo: nell'output scrivi sempre l'anno in cifre, mai "AAAA"
+5. Per l'azione "list", il campo "summary" è opzionale e può essere usato come filtro
+
+"ATTENZIONE: Il 'summary' DEVE corrispondere ESATTAMENTE al titolo esistente nell'agenda"
+
+Istruzioni chiave:
+1. Per comandi tipo "sposta X da Y a Z":
+   - 'summary' = X (senza riferimenti a Y/Z)
+   - 'date'/'time' = Y (orario originale)
+   - 'start'/'end' = Z (nuovo orario)
+
+Esempi corretti:
+- Input: "Inserisci una riunione con il team domani pomeriggio alle 14 per 2 ore"
+  Output: {{
+    "action": "add",
+    "summary": "riunione con il team",
+    "start": "AAAA-05-30T14:00:00",
+    "end": "AAAA-05-30T16:00:00"
+  }}
+- Input: "Elimina l'appuntamento del 5 giugno alle 9:30"
+  Output: {{
+    "action": "delete", 
+    "summary": "appuntamento", # <-- Solo il titolo, nessun riferimento temporale
+    "date": "AAAA-06-05",
+    "time": "09:30"
+  }}
+- Input: "Sposta la call di marketing da oggi alle 11 a domani alle 15"
+  Output: {{
+    "action": "modify",
+    "event_id": "", 
+    "summary": "call di marketing", # <-- Solo il titolo, nessun riferimento temporale
+    "start": "AAAA-05-30T15:00:00",
+    "end": "AAAA-05-30T16:00:00"
+  }}
+- Input: "Rinvia la riunione di oggi alle 14 a dopodomani alle 16"
+  Output: {{
+    "action": "modify",
+    "summary": "riunione",
+    "date": "AAAA-03-08",    // Data originale (oggi)
+    "time": "14:00",                   // Ora originale
+    "start": "AAAA-03-10T16:00:00", // Nuovo orario
+    "end": "AAAA-03-10T17:00:00"
+}}  
+- Input: "Mostrami tutti gli eventi"
+  Output: {{
+    "action": "list"
+  }}
+- Input: "Quali appuntamenti ho giovedì?"
+  Output: {{
+    "action": "list",
+    "date": "AAAA-05-30"
+  }}
+- Input: "Elenca le riunioni di questa settimana"
+  Output: {{
+    "action": "list",
+    "summary": "riunioni"
+  }}
+"""
+
+DYNAMIC_SUFFIX = """
+Anno corrente: {current_year}
+Input corrente: {user_input}
+"""
+
+PROMPT_TEMPLATE = STATIC_PROMPT + DYNAMIC_SUFFIX
+
+class CommandCache:
+    """Cache in memoria dei comandi già interpretati dall'LLM."""
+    def __init__(self, ttl=3600, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+
+    @staticmethod
+    def _normalize(user_input: str) -> str:
+        return " ".join(user_input.lower().split())
+
+    def _key(self, user_input: str, current_year: int):
+        normalized = self._normalize(user_input)
+        if set(re.findall(r"\w+", normalized)) & RELATIVE_TIME_TOKENS:
+            return None  # La data assoluta cambierebbe da un giorno all'altro
+        return hashlib.sha1(f"{current_year}:{normalized}".encode()).hexdigest()
+
+    def get(self, user_input: str, current_year: int):
+        key = self._key(user_input, current_year)
+        entry = self._entries.get(key) if key else None
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        return dict(data)
+
+    def set(self, user_input: str, current_year: int, data: dict) -> None:
+        key = self._key(user_input, current_year)
+        if not key:
+            return
+        if key not in self._entries and len(self._entries) >= self.max_size:
+            # Rimuove la voce più vecchia (ordine di inserimento)
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = (time.monotonic() + self.ttl, dict(data))
+
+_CANCEL_BTN = InlineKeyboardButton("❌ Annulla", callback_data="delete_cancel")
+
+@functools.lru_cache(maxsize=512)
+def _build_delete_keyboard(date: str, time: str, label: str = "✅ Conferma") -> InlineKeyboardMarkup:
+    """Tastiera di conferma cancellazione (gli oggetti Telegram sono immutabili)."""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(label, callback_data=f"delete_confirm:{date}:{time}"),
+        _CANCEL_BTN
+    ]])
 
 class CalendarAgent:
     def __init__(self):
         self.db = Database()
-        self.calendar = GoogleCalendar()
-        self.gmail = GmailService()
-        self.health_server = HealthServer() if os.getenv('ENV') == 'prod' else None
-        self.llm_chain = self._init_llm_chain()
+        self.calendar = GoogleCalendar.get()
+        self.gmail = GmailService.get()
+        self.llm = self._init_llm()
+        self.command_cache = CommandCache()
+        self._llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+        self._inflight_prompts: dict[str, asyncio.Task] = {}
+        self._pending_tasks: set[asyncio.Task] = set()
+        self._pending_writes: set[asyncio.Task] = set()
+        self._health_runner = None
+        self._year_cache: tuple[float, int] = (0.0, 0)  # (timestamp, anno)
+        # Tabella azione -> handler usata da _execute_action
+        self._actions = {
+            "add": self._add_event,
+            "delete": self._confirm_delete,
+            "modify": self._modify_event,
+            "list": lambda update, action_data: self._list_events(),
+            "start": lambda update, action_data: self._start(),
+        }
     
-    def _init_llm_chain(self):
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def _init_llm(cls):
+        """Crea il modello Gemini una sola volta per processo."""
         try:
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-1.5-pro-002",
-                google_api_key=os.getenv("GOOGLE_API_KEY"),
-                temperature=0.7
+            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+            return genai.GenerativeModel(
+                "gemini-1.5-pro-002",
+                generation_config={
+                    "temperature": 0.7,
+                    "response_mime_type": "application/json",
+                    "response_schema": ACTION_SCHEMA,
+                }
             )
-            
-            template = self._create_prompt()
-            prompt = PromptTemplate(
-                template=template,
-                input_variables=["user_input", "current_year"],
-                template_format="f-string"
-            )
-            
-            # Create a pipeline using the new style
-            return prompt | llm
         except Exception as e:
-            logging.error(f"Error initializing LLM chain: {str(e)}")
+            logging.error(f"Error initializing LLM: {str(e)}")
             raise RuntimeError(f"Failed to initialize LLM: {str(e)}. Check your API key and model access.")
 
-    def _create_prompt(self):
-        """Crea il prompt per l'LLM."""
-        return """
-        Analizza il comando utente e genera un JSON strutturato.
-        Considera questi sinonimi:
-        - Creazione: aggiungi, crea, nuovo, inserisci, programma
-        - Eliminazione: cancella, elimina, rimuovi, annulla
-        - Modifica: modifica, cambia, aggiorna, sposta, riprogramma, rinvia
-        - Lista: mostra, elenca, lista, visualizza, vedi, dammi, quali
-        
-        Linee guida critiche:
-        1. Il campo 'summary' DEVE contenere SOLO il titolo base dell'evento
-        2. Rimuovi ASSOLUTAMENTE riferimenti temporali dal 'summary' (es. "delle 15", "del 12 marzo")
-        3. Per 'modify'/'delete' senza event_id:
-           - 'date' e 'time' devono sempre riflettere la data/ora ORIGINALE
-           - Usa il formato ISO8601 per tutti i campi temporali
-        4. Per le azioni di modifica, includi SEMPRE sia i nuovi orari (start/end) che quelli originali (date/time)
-
-        Struttura JSON:
-        {{
-            "action": "add|delete|modify|list",
-            "summary": "stringa",             // SOLO titolo, senza date/orari
-            "start": "YYYY-MM-DDTHH:MM:SS",   // Obbligatorio per add/modify (NUOVO orario)
-            "end": "YYYY-MM-DDTHH:MM:SS",     // Obbligatorio per add/modify (NUOVO orario)
-            "event_id": "stringa",            // Obbligatorio solo se specificato
-            "date": "YYYY-MM-DD",             // Obbligatorio per delete/modify senza event_id (DATA ORIGINALE)
-            "time": "HH:MM"                   // Obbligatorio per delete/modify senza event_id (ORA ORIGINALE)
-        }}
-        
-        Istruzioni:
-        1. Per le date relative (es. "domani", "lunedì prossimo") usa la data assoluta
-        2. Per gli orari: "alle 15" -> 15:00:00, "16:30" -> 16:30:00
-        3. Se mancano informazioni critiche, deducile dal contesto
-        4. IMPORTANTE: Se non vieve specificato l'anno usa sempre l'anno corrente ({current_year}) per tutte le date
-        5. Per l'azione "list", il campo "summary" è opzionale e può essere usato come filtro
-
-        "ATTENZIONE: Il 'summary' DEVE corrispondere ESATTAMENTE al titolo esistente nell'agenda"
-
-        Istruzioni chiave:
-        1. Per comandi tipo "sposta X da Y a Z":
-           - 'summary' = X (senza riferimenti a Y/Z)
-           - 'date'/'time' = Y (orario originale)
-           - 'start'/'end' = Z (nuovo orario)
-        2. Per date relative ("domani", "lunedì prossimo"):
-           - Converti in data assoluta usando l'anno corrente
-        3. Per orari:
-           - "alle 15" → 15:00, "16 e 30" → 16:30
-        4. Se mancano dettagli critici, deducili dal contesto
-        
-        Esempi corretti:
-        - Input: "Inserisci una riunione con il team domani pomeriggio alle 14 per 2 ore"
-          Output: {{
-            "action": "add",
-            "summary": "riunione con il team",
-            "start": "{current_year}-05-30T14:00:00",
-            "end": "{current_year}-05-30T16:00:00"
-          }}
-        - Input: "Elimina l'appuntamento del 5 giugno alle 9:30"
-          Output: {{
-            "action": "delete", 
-            "summary": "appuntamento", # <-- Solo il titolo, nessun riferimento temporale
-            "date": "{current_year}-06-05",
-            "time": "09:30"
-          }}
-        - Input: "Sposta la call di marketing da oggi alle 11 a domani alle 15"
-          Output: {{
-            "action": "modify",
-            "event_id": "", 
-            "summary": "call di marketing", # <-- Solo il titolo, nessun riferimento temporale
-            "start": "{current_year}-05-30T15:00:00",
-            "end": "{current_year}-05-30T16:00:00"
-          }}
-        - Input: "Rinvia la riunione di oggi alle 14 a dopodomani alle 16"
-          Output: {{
-            "action": "modify",
-            "summary": "riunione",
-            "date": "{current_year}-03-08",    // Data originale (oggi)
-            "time": "14:00",                   // Ora originale
-            "start": "{current_year}-03-10T16:00:00", // Nuovo orario
-            "end": "{current_year}-03-10T17:00:00"
-        }}  
-        - Input: "Mostrami tutti gli eventi"
-          Output: {{
-            "action": "list"
-          }}
-        - Input: "Quali appuntamenti ho giovedì?"
-          Output: {{
-            "action": "list",
-            "date": "{current_year}-05-30"
-          }}
-        - Input: "Elenca le riunioni di questa settimana"
-          Output: {{
-            "action": "list",
-            "summary": "riunioni"
-          }}          
-        
-        Input corrente: {user_input}
-        """
+    async def _generate(self, prompt: str) -> str:
+        """Genera la risposta in streaming e si ferma appena il JSON è completo."""
+        async with self._llm_slots:
+            response = await self.llm.generate_content_async(prompt, stream=True)
+            response_text = ""
+            async for chunk in response:
+                try:
+                    response_text += chunk.text
+                except ValueError:
+                    continue  # Chunk senza testo (es. solo finish_reason)
+                try:
+                    orjson.loads(response_text)
+                except orjson.JSONDecodeError:
+                    continue  # JSON ancora incompleto
+                break  # Il resto dello stream (solo spazi) non serve
+            return response_text
+
+    async def _generate_shared(self, prompt: str) -> str:
+        """Prompt identici già in corso condividono un'unica chiamata a Gemini."""
+        task = self._inflight_prompts.get(prompt)
+        if task is None:
+            task = asyncio.create_task(self._generate(prompt))
+            self._inflight_prompts[prompt] = task
+            task.add_done_callback(lambda _: self._inflight_prompts.pop(prompt, None))
+        # shield: se un chiamante viene annullato la chiamata continua per gli altri
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _chat_lock(context: ContextTypes.DEFAULT_TYPE) -> asyncio.Lock:
+        """Lock per chat: i messaggi della stessa chat restano in ordine."""
+        return context.chat_data.setdefault("lock", asyncio.Lock())
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_input = update.message.text
-        try:
-            action_data = self.parse_command(user_input)
-            response = await self._execute_action(update, action_data)
-            if response is not None:  # Invia risposta solo se ce n'è una
-                await update.message.reply_text(response)
-        
-        except Exception as e:
-            logger.error(f"Errore: {str(e)}", exc_info=True)
-            await update.message.reply_text("❌ Errore durante l'operazione.")
+        async with self._chat_lock(context):
+            try:
+                action_data = await self.parse_command(user_input)
+                response = await self._execute_action(update, action_data)
+                if response is not None:  # Invia risposta solo se ce n'è una
+                    await update.message.reply_text(response)
+
+            except Exception as e:
+                logger.error(f"Errore: {str(e)}", exc_info=True)
+                await update.message.reply_text("❌ Errore durante l'operazione.")
+
+    def _current_year(self) -> int:
+        """Anno corrente in Europe/Rome, ricalcolato al massimo una volta l'ora."""
+        now = time.time()
+        if now - self._year_cache[0] > 3600:
+            self._year_cache = (now, datetime.now(TIMEZONE).year)
+        return self._year_cache[1]
 
-    def parse_command(self, user_input: str) -> dict:
+    @staticmethod
+    def _fast_parse(user_input: str):
+        """Riconosce i comandi banali senza LLM; None se serve Gemini."""
+        if _START_RE.match(user_input):
+            return {"action": "start"}
+        if _LIST_RE.match(user_input):
+            return {"action": "list"}
+        return None
+
+    async def parse_command(self, user_input: str) -> dict:
+        fast = self._fast_parse(user_input)
+        if fast is not None:
+            return fast
+        
         try:
-            # Get current year
-            current_year = datetime.now().year
-            
-            # Using the new pipeline style with current_year
-            response = self.llm_chain.invoke({
-                "user_input": user_input,
-                "current_year": current_year
-            })
+            current_year = self._current_year()
+
+            cached = self.command_cache.get(user_input, current_year)
+            if cached is not None:
+                logger.info(f"Comando servito dalla cache: {cached}")
+                return cached
             
-            # In the new style, response might be formatted differently
-            if hasattr(response, 'content'):
-                # If using ChatGoogleGenerativeAI
-                response_text = response.content
-            else:
-                # Fallback for other response formats
-                response_text = str(response)
+            response_text = await self._generate_shared(PROMPT_TEMPLATE.format(
+                user_input=user_input,
+                current_year=current_year
+            ))
                 
-            cleaned = response_text.strip().replace('```json', '').replace('```', '').replace("'", '"')
+            logger.info(f"Raw LLM response: {response_text}")
             
-            logger.info(f"Raw LLM response: {response}")
-            logger.info(f"Cleaned response: {cleaned}")
-            
-            data = json.loads(cleaned)
+            data = orjson.loads(response_text)
             
             # Validazione campi obbligatori
             if 'action' not in data:
                 raise ValueError("Campo 'action' mancante")
-                
+
+            self.command_cache.set(user_input, current_year, data)
             return data
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON non valido: {cleaned}, errore: {str(e)}")
+        except orjson.JSONDecodeError as e:
+            logger.error(f"JSON non valido: {response_text}, errore: {str(e)}")
             raise ValueError("Formato risposta non riconosciuto")
         except Exception as e:
             logger.error(f"Errore parsing: {str(e)}")
@@ -249,31 +369,58 @@ class CalendarAgent:
     async def _execute_action(self, update: Update, action_data: dict) -> str:
         action = action_data.get("action")
         
+        handler = self._actions.get(action)
+        if handler is None:
+            return "❌ Azione non supportata."
+        
         try:
-            if action == "add":
-                return await self._add_event(update, action_data)
-            elif action == "delete":
-                result = await self._confirm_delete(update, action_data)
-                return result if result is not None else None  # Gestisce il caso in cui _confirm_delete non restituisce nulla
-            elif action == "modify":
-                return await self._modify_event(update, action_data)
-            elif action == "list":
-                return await self._list_events()
-            else:
-                return "❌ Azione non supportata."
+            # _confirm_delete restituisce None quando ha già risposto con i bottoni
+            return await handler(update, action_data)
         except Exception as e:
-            await self.gmail.send_email(
+            self._send_email_later(
                 to="g.canale@escom.it",  # Indirizzo fisso per la demo
                 subject="Errore operazione",
                 body=f"Errore durante {action}: {str(e)}"
             )
             raise
 
+    async def _safe_send_email(self, to: str, subject: str, body: str) -> None:
+        """Invia un'email senza propagare errori: le notifiche non bloccano le risposte."""
+        try:
+            await self.gmail.send_email(to=to, subject=subject, body=body)
+        except Exception as e:
+            logger.error(f"❌ Errore invio email '{subject}': {str(e)}")
+
+    def _run_in_background(self, coro) -> asyncio.Task:
+        """Avvia una coroutine senza attenderla, tenendo un riferimento al task."""
+        task = asyncio.create_task(coro)
+        # Mantiene un riferimento al task finché non termina
+        self._pending_tasks.add(task)
+        task.add_done_callback(self._pending_tasks.discard)
+        return task
+
+    def _send_email_later(self, to: str, subject: str, body: str) -> None:
+        """Invia l'email in background, senza attendere la risposta di Gmail."""
+        self._run_in_background(self._safe_send_email(to, subject, body))
+
+    def _upsert_event_later(self, event_data: dict) -> None:
+        """Salva l'evento nel DB in background; le letture successive lo attendono."""
+        task = self._run_in_background(asyncio.to_thread(self.db.upsert_event, event_data))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    async def _db_read(self, func, *args):
+        """Esegue una lettura dal DB dopo che le scritture in background sono terminate."""
+        if self._pending_writes:
+            await asyncio.wait(set(self._pending_writes))
+        return await asyncio.to_thread(func, *args)
+
     async def _add_event(self, update: Update, action_data: dict) -> str:
         # Add debug log here
         logging.info(f"Attempting to create calendar event: {action_data}")
         
-        event = self.calendar.create_event(
+        event = await asyncio.to_thread(
+            self.calendar.create_event,
             action_data["summary"],
             action_data["start"],
             action_data["end"]
@@ -282,14 +429,15 @@ class CalendarAgent:
         # Add debug log here
         logging.info(f"Calendar event creation result: {event}")
         
-        self.db.upsert_event({
+        # DB e notifica non servono per la risposta: partono in background
+        self._upsert_event_later({
             "event_id": event["id"],
             "summary": action_data["summary"],
             "start_time": action_data["start"],
             "end_time": action_data["end"]
         })
         
-        await self.gmail.send_email(
+        self._send_email_later(
             to="g.canale@escom.it",  # Indirizzo fisso per la demo,
             subject="Nuovo evento creato",
             body=f"Evento creato: {action_data['summary']}\nOra: {action_data['start']}"
@@ -307,7 +455,7 @@ class CalendarAgent:
         if not event_id or event_id == "ID_DA_CERCARE_IN_DB":
             # Search for events by summary
             logging.info(f"Searching for events with summary: {action_data['summary']}")
-            events = self.db.get_events_by_summary(action_data["summary"])
+            events = await self._db_read(self.db.get_events_by_summary, action_data["summary"])
             
             if not events:
                 return "❌ Nessun evento trovato con questo titolo."
@@ -323,22 +471,23 @@ class CalendarAgent:
         
         try:
             # Update the event with the real ID
-            event = self.calendar.update_event(
+            event = await asyncio.to_thread(
+                self.calendar.update_event,
                 event_id,
                 action_data["summary"],
                 action_data["start"],
                 action_data["end"]
             )
             
-            # Update the database
-            self.db.upsert_event({
+            # Update the database (in background, come la notifica)
+            self._upsert_event_later({
                 "event_id": event["id"],
                 "summary": action_data["summary"],
                 "start_time": action_data["start"],
                 "end_time": action_data["end"]
             })
             
-            await self.gmail.send_email(
+            self._send_email_later(
                 to="g.canale@escom.it",  # Indirizzo fisso per la demo,
                 subject="Evento modificato",
                 body=f"Evento modificato: {action_data['summary']}\nNuovo orario: {action_data['start']}"
@@ -350,9 +499,13 @@ class CalendarAgent:
             logging.error(f"Error modifying event: {str(e)}")
             return f"❌ Errore durante la modifica dell'evento: {str(e)}"
 
+    async def _start(self) -> str:
+        """Messaggio di benvenuto per /start."""
+        return "👋 Ciao! Dimmi quale evento aggiungere, modificare, eliminare o mostrare."
+
     async def _list_events(self) -> str:
         """Lista tutti gli eventi."""
-        events = self.db.get_events()
+        events = await self._db_read(self.db.get_events)
         if not events:
             return "🗓️ Nessun evento trovato."
         return "\n".join([f"{e['summary']} ({e['start_time']})" for e in events])
@@ -362,22 +515,23 @@ class CalendarAgent:
         query = update.callback_query
         await query.answer()
 
-        # Verifica prima se inizia con delete_confirm
-        if query.data.startswith("delete_confirm:"):
-            # Divide solo alla prima e seconda occorrenza di ":"
-            parts = query.data.split(":", 2)
-            if len(parts) >= 3:
-                action = parts[0]
-                date = parts[1]
-                time = parts[2]
-                await self._delete_event(query, date, time)
+        async with self._chat_lock(context):
+            # Verifica prima se inizia con delete_confirm
+            if query.data.startswith("delete_confirm:"):
+                # Divide solo alla prima e seconda occorrenza di ":"
+                parts = query.data.split(":", 2)
+                if len(parts) >= 3:
+                    action = parts[0]
+                    date = parts[1]
+                    time = parts[2]
+                    await self._delete_event(query, date, time)
+                else:
+                    # Gestisci il caso in cui non ci sono abbastanza parti
+                    await query.edit_message_text("❌ Dati di callback non validi.")
+            elif query.data == "delete_cancel":
+                await query.edit_message_text("❌ Cancellazione annullata.")
             else:
-                # Gestisci il caso in cui non ci sono abbastanza parti
-                await query.edit_message_text("❌ Dati di callback non validi.")
-        elif query.data == "delete_cancel":
-            await query.edit_message_text("❌ Cancellazione annullata.")
-        else:
-            await query.edit_message_text("❌ Azione non riconosciuta.")
+                await query.edit_message_text("❌ Azione non riconosciuta.")
 
     async def _confirm_delete(self, update: Update, action_data: dict) -> str:
         """Mostra una conferma prima di eliminare un evento."""
@@ -391,51 +545,24 @@ class CalendarAgent:
         if not date:
             return "❌ Data non specificata per la cancellazione."
         
-        # Cerca eventi in quella data
-        events = self.db.get_events_by_date(date)
+        # Cerca eventi in quella data: ora e titolo sono filtri facoltativi,
+        # se non trovano nulla la ricerca viene allargata
+        events = []
+        for time_filter, summary_filter in dict.fromkeys([(time, summary), (time, ""), ("", summary), ("", "")]):
+            events = await self._db_read(
+                self.db.get_events_by_date_time_summary, date, time_filter, summary_filter
+            )
+            if events:
+                break
         
         if not events:
             return f"❌ Nessun evento trovato per il {date}."
         
-        # Filtra per ora se specificata
-        if time:
-            filtered_events = []
-            for e in events:
-                # Handle both string and datetime objects
-                if isinstance(e['start_time'], str):
-                    event_time = e['start_time'].split('T')[1]
-                else:
-                    # Format datetime object to string
-                    event_time = e['start_time'].strftime('%H:%M:%S')
-                
-                if event_time.startswith(time):
-                    filtered_events.append(e)
-                    
-            if filtered_events:
-                events = filtered_events
-        
-        # Filtra per titolo se specificato
-        if summary:
-            filtered_events = [e for e in events if summary.lower() in e['summary'].lower()]
-            if filtered_events:
-                events = filtered_events
-        
         if len(events) == 1:
             event = events[0]
+            event_time = event['start_hhmm']
             
-            # Get event time in proper format
-            if isinstance(event['start_time'], str):
-                event_time = event['start_time'].split('T')[1][:5]
-            else:
-                event_time = event['start_time'].strftime('%H:%M')
-                
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Conferma", callback_data=f"delete_confirm:{date}:{time}"),
-                    InlineKeyboardButton("❌ Annulla", callback_data="delete_cancel")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _build_delete_keyboard(date, time)
             
             # Invia direttamente il messaggio con i bottoni
             await update.message.reply_text(
@@ -445,23 +572,8 @@ class CalendarAgent:
             return None  # Non restituiamo nulla perché abbiamo già inviato il messaggio
         else:
             # Multiple events found
-            events_text = []
-            for e in events[:5]:
-                if isinstance(e['start_time'], str):
-                    event_time = e['start_time'].split('T')[1][:5]
-                else:
-                    event_time = e['start_time'].strftime('%H:%M')
-                
-                events_text.append(f"- {e['summary']} ({event_time})")
-                
-            events_str = "\n".join(events_text)
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Elimina tutti", callback_data=f"delete_confirm:{date}:{time}"),
-                    InlineKeyboardButton("❌ Annulla", callback_data="delete_cancel")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            events_str = "\n".join(f"- {e['summary']} ({e['start_hhmm']})" for e in events[:5])
+            reply_markup = _build_delete_keyboard(date, time, "✅ Elimina tutti")
         
             # Invia direttamente il messaggio con i bottoni
             await update.message.reply_text(
@@ -472,68 +584,80 @@ class CalendarAgent:
 
     async def _delete_event(self, query, date: str, time: str) -> str:
         """Elimina un evento."""
-        events = self.db.get_events_by_date(date)
-        
-        target_events = []
-        for e in events:
-            # Gestisci sia oggetti datetime che stringhe
-            if isinstance(e['start_time'], str):
-                event_time = e['start_time'].split('T')[1]
-            else:
-                # Converti datetime in stringa nel formato appropriato
-                event_time = e['start_time'].strftime('%H:%M:%S')
-                
-            if event_time.startswith(time):
-                target_events.append(e)
+        target_events = await self._db_read(self.db.get_events_by_date_time_summary, date, time)
         
         if not target_events:
             await query.edit_message_text("❌ Nessun evento trovato.")
             return
         
-        deleted_events = []
-        for event in target_events:
-            self.calendar.delete_event(event['event_id'])
-            self.db.delete_event(event['event_id'])
-            deleted_events.append(event)
+        # Una sola richiesta batch a Google Calendar per tutti gli eventi
+        deleted_ids = set(await asyncio.to_thread(
+            self.calendar.delete_events,
+            [e['event_id'] for e in target_events]
+        ))
+        deleted_events = [e for e in target_events if e['event_id'] in deleted_ids]
         
-        # Aggiungi qui l'invio email per la cancellazione
-        try:
-            # Per ogni evento cancellato, invia una notifica via email
-            for event in deleted_events:
-                # Converti start_time in stringa se è un datetime
-                start_time_str = event['start_time']
-                if not isinstance(start_time_str, str):
-                    start_time_str = event['start_time'].strftime('%Y-%m-%dT%H:%M:%S')
-                    
-                await self.gmail.send_email(
-                    to="g.canale@escom.it",  # Indirizzo fisso per la demo
-                    subject="Evento cancellato",
-                    body=f"È stato cancellato l'evento: {event['summary']}\nData/ora: {start_time_str}"
-                )
-            logger.info(f"Inviate {len(deleted_events)} email di notifica per cancellazione eventi")
-        except Exception as e:
-            logger.error(f"❌ Errore invio email per cancellazione: {str(e)}")
+        # Per ogni evento cancellato, invia una notifica via email (in parallelo)
+        emails = []
+        for event in deleted_events:
+            emails.append(self._safe_send_email(
+                to="g.canale@escom.it",  # Indirizzo fisso per la demo
+                subject="Evento cancellato",
+                body=f"È stato cancellato l'evento: {event['summary']}\nData/ora: {event['start_iso']}"
+            ))
+        # Cancellazione dal DB (unica query) e notifiche partono insieme
+        await asyncio.gather(
+            asyncio.to_thread(self.db.delete_events, list(deleted_ids)),
+            *emails,
+            return_exceptions=True
+        )
+        logger.info(f"Inviate {len(deleted_events)} email di notifica per cancellazione eventi")
     
-        await query.edit_message_text(f"🗑️ Eliminati {len(target_events)} eventi.")
+        await query.edit_message_text(f"🗑️ Eliminati {len(deleted_events)} eventi.")
+
+    @staticmethod
+    async def _health(request: web.Request) -> web.Response:
+        return web.Response(text='OK')
+
+    async def _start_health_server(self) -> None:
+        """Avvia l'health check HTTP sullo stesso event loop del bot."""
+        health_app = web.Application()
+        health_app.router.add_get('/', self._health)
+        self._health_runner = web.AppRunner(health_app)
+        await self._health_runner.setup()
+        await web.TCPSite(self._health_runner, '0.0.0.0', HEALTH_PORT).start()
+        logger.info(f"Health check server avviato su porta {HEALTH_PORT}")
+
+    async def _post_init(self, app: Application) -> None:
+        if os.getenv('ENV') == 'prod':
+            await self._start_health_server()
+
+    async def _post_shutdown(self, app: Application) -> None:
+        await self.gmail.close()
+        if self._health_runner:
+            await self._health_runner.cleanup()
+            logger.info("Health check server fermato")
 
     def run(self):
         """Avvia il bot."""
-        if self.health_server:
-            self.health_server.start()
-        
-        app = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+        # Gli update vengono gestiti in parallelo tra chat diverse (vedi _chat_lock)
+        app = (
+            Application.builder()
+            .token(os.getenv('TELEGRAM_TOKEN'))
+            .concurrent_updates(64)
+            .update_queue(asyncio.Queue(maxsize=1000))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
         app.add_handler(CommandHandler("start", self.handle_message))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         app.add_handler(CallbackQueryHandler(self.button_callback))
-        app.run_polling()
+        app.run_polling(timeout=30)
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
 
     bot = CalendarAgent()
-    try:
-        bot.run()
-    finally:
-        if bot.health_server:
-            bot.health_server.stop()
\ No newline at end of file
+    bot.run()
\ No newline at end of file
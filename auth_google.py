@@ -1,35 +1,29 @@
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_clients import SCOPES, atomic_write, get_credentials_path
 import os
-import json
+import orjson
 import logging
 
-logging.basicConfig(level=logging.INFO)
-
-SCOPES = [
-    'https://www.googleapis.com/auth/calendar',
-    'https://www.googleapis.com/auth/gmail.send'
-]
-
-def get_credentials_path():
-    """Restituisce il percorso corretto per le credenziali."""
-    if os.getenv('ENV') == 'prod':
-        # Modalità produzione: usa il percorso di Render
-        return '/etc/secrets/credentials.json'
-    else:
-        # Modalità sviluppo: usa il percorso locale
-        return 'credentials/credentials.json'
+def _save_credentials(creds, creds_path, old_json=None):
+    """Scrive le credenziali solo se cambiate, sostituendo il file in modo atomico."""
+    new_json = creds.to_json()
+    if new_json == old_json:
+        return
+    atomic_write(creds_path, new_json.encode())
 
 def authenticate_google():
     """Autentica l'utente con Google OAuth."""
     creds = None
+    old_json = None
     creds_path = get_credentials_path()
     
     # Se esiste già un file di token, caricalo
     if os.path.exists(creds_path):
         with open(creds_path, 'r') as token:
-            creds = Credentials.from_authorized_user_info(json.load(token), SCOPES)
+            old_json = token.read()
+        creds = Credentials.from_authorized_user_info(orjson.loads(old_json), SCOPES)
     
     # Se non ci sono credenziali valide, esegui il flusso OAuth
     if not creds or not creds.valid:
@@ -43,10 +37,10 @@ def authenticate_google():
             creds = flow.run_local_server(port=0)
         
         # Salva le credenziali per il prossimo avvio
-        with open(creds_path, 'w') as token:
-            token.write(creds.to_json())
+        _save_credentials(creds, creds_path, old_json)
     
     return creds
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     authenticate_google()
\ No newline at end of file
@@ -1,63 +1,195 @@
 import os
-import psycopg2
-from psycopg2 import sql
-from psycopg2.extras import RealDictCursor
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+from cachetools import TTLCache
 from dotenv import load_dotenv
 import logging
+import threading
 
 load_dotenv()
-logging.basicConfig(level=logging.INFO)
+
+# Colonne lette dall'agente: niente SELECT *, così created_at & co. non viaggiano sulla rete
+EVENT_COLUMNS = "event_id, summary, start_time, end_time"
+
+# Gli orari arrivano senza offset ("AAAA-MM-DDTHH:MM:SS", ora di Roma): la sessione deve
+# leggerli come Europe/Rome, la stessa zona usata da query e indici (AT TIME ZONE 'Europe/Rome')
+SESSION_OPTIONS = "-c TimeZone=Europe/Rome"
+
+# TCP keepalive: evita che NAT/load balancer chiudano in silenzio le connessioni inattive
+KEEPALIVE = {
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 5,
+}
+
+# Cache delle letture: le stesse ricerche si ripetono a pochi secondi di distanza
+READ_CACHE_SIZE = 256
+READ_CACHE_TTL = 30
+
+# Oltre questa soglia bulk_upsert_events carica le righe con COPY
+COPY_THRESHOLD = 1000
+
+# Query costruite una sola volta all'import
+SELECT_BY_SUMMARY_SQL = f"SELECT {EVENT_COLUMNS} FROM agent_events WHERE summary ILIKE %s"
+
+# Stessa espressione di idx_events_start_date_rome, così il planner usa l'indice
+SELECT_BY_DATE_SQL = f"""
+    SELECT {EVENT_COLUMNS} FROM agent_events
+    WHERE DATE(start_time AT TIME ZONE 'Europe/Rome') = %s
+    ORDER BY start_time
+"""
+
+SELECT_BY_DATE_TIME_SUMMARY_SQL = f"""
+    SELECT {EVENT_COLUMNS},
+           to_char(start_time AT TIME ZONE 'Europe/Rome', 'HH24:MI') AS start_hhmm,
+           to_char(start_time AT TIME ZONE 'Europe/Rome', 'YYYY-MM-DD"T"HH24:MI:SS') AS start_iso
+    FROM agent_events
+    WHERE DATE(start_time AT TIME ZONE 'Europe/Rome') = %s
+      AND to_char(start_time AT TIME ZONE 'Europe/Rome', 'HH24:MI:SS') LIKE %s
+      AND summary ILIKE %s
+    ORDER BY start_time
+"""
+
+SELECT_ALL_SQL = f"SELECT {EVENT_COLUMNS} FROM agent_events ORDER BY start_time"
+
+UPSERT_SQL = f"""
+    INSERT INTO agent_events ({EVENT_COLUMNS})
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (event_id) DO UPDATE SET
+        summary = EXCLUDED.summary,
+        start_time = EXCLUDED.start_time,
+        end_time = EXCLUDED.end_time
+"""
+
+CREATE_TMP_EVENTS_SQL = """
+    CREATE TEMP TABLE tmp_events (
+        event_id VARCHAR(255),
+        summary TEXT,
+        start_time TIMESTAMPTZ,
+        end_time TIMESTAMPTZ,
+        ordinal INTEGER
+    ) ON COMMIT DROP
+"""
+
+COPY_TMP_EVENTS_SQL = f"COPY tmp_events ({EVENT_COLUMNS}, ordinal) FROM STDIN"
+
+# DISTINCT ON: ON CONFLICT non può aggiornare due volte la stessa riga;
+# l'ordinale tiene l'ultima occorrenza, come fa executemany sotto la soglia
+UPSERT_FROM_TMP_SQL = f"""
+    INSERT INTO agent_events ({EVENT_COLUMNS})
+    SELECT DISTINCT ON (event_id) {EVENT_COLUMNS}
+    FROM tmp_events
+    ORDER BY event_id, ordinal DESC
+    ON CONFLICT (event_id) DO UPDATE SET
+        summary = EXCLUDED.summary,
+        start_time = EXCLUDED.start_time,
+        end_time = EXCLUDED.end_time
+"""
+
+DELETE_SQL = "DELETE FROM agent_events WHERE event_id = %s"
+
+DELETE_MANY_SQL = "DELETE FROM agent_events WHERE event_id = ANY(%s)"
+
+def _escape_like(value: str) -> str:
+    """Neutralizza i caratteri jolly di LIKE nel valore cercato."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 class Database:
     def __init__(self):
-        self.conn = self._connect()
+        self.pool = self._create_pool(max_size=4)
+        # Le letture non aprono transazioni: niente BEGIN/COMMIT né snapshot tenuti aperti
+        self.read_pool = self._create_pool(max_size=6, autocommit=True)
+        self._read_cache = TTLCache(maxsize=READ_CACHE_SIZE, ttl=READ_CACHE_TTL)
+        self._cache_lock = threading.Lock()
+        # Incrementato a ogni scrittura: una lettura iniziata prima non finisce in cache
+        self._cache_generation = 0
         self._init_db()
     
-    def _connect(self):
+    def _create_pool(self, max_size: int, autocommit: bool = False):
         try:
             if os.getenv('ENV') == 'prod':
-                return psycopg2.connect(
-                    os.getenv('DATABASE_URL'), 
+                conninfo = make_conninfo(
+                    os.getenv('DATABASE_URL'),
                     sslmode='require',
-                    cursor_factory=RealDictCursor
+                    options=SESSION_OPTIONS,
+                    **KEEPALIVE
                 )
             else:
-                return psycopg2.connect(
+                conninfo = make_conninfo(
                     host=os.getenv('DB_HOST'),
                     dbname=os.getenv('DB_NAME'),
                     user=os.getenv('DB_USER'),
                     password=os.getenv('DB_PASSWORD'),
-                    cursor_factory=RealDictCursor
+                    options=SESSION_OPTIONS,
+                    **KEEPALIVE
                 )
+            pool = ConnectionPool(
+                conninfo=conninfo,
+                min_size=1,
+                max_size=max_size,
+                # Le query di lettura/cancellazione usano prepare=True; le altre vengono
+                # preparate dal server dopo 3 esecuzioni sulla stessa connessione
+                kwargs={"row_factory": dict_row, "prepare_threshold": 3, "autocommit": autocommit},
+                # Scarta le connessioni cadute prima di consegnarle, invece di fallire la query
+                check=ConnectionPool.check_connection,
+                open=True
+            )
+            pool.wait()  # Fallisce subito se il DB non è raggiungibile
+            return pool
         except Exception as e:
             logging.error(f"DB Connection Error: {str(e)}")
             raise
     
+    def _fetch_cached(self, key: tuple, query: str, params: tuple) -> list:
+        """Esegue la SELECT o restituisce il risultato in cache; gli errori non vengono memorizzati."""
+        with self._cache_lock:
+            rows = self._read_cache.get(key)
+            generation = self._cache_generation
+        if rows is not None:
+            return rows
+        # I cursori di psycopg3 sono leggeri: conn.execute ne usa uno usa e getta
+        with self.read_pool.connection() as conn:
+            rows = conn.execute(query, params, prepare=True).fetchall()
+        with self._cache_lock:
+            if generation == self._cache_generation:
+                self._read_cache[key] = rows
+        return rows
+    
+    def _invalidate_reads(self):
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._read_cache.clear()
+    
     def get_events_by_summary(self, summary: str) -> list:
         try:
-            query = "SELECT * FROM agent_events WHERE summary ILIKE %s"
-            with self.conn.cursor() as cur:
-                cur.execute(query, (f"%{summary}%",))
-                return cur.fetchall()
+            return self._fetch_cached(('summary', summary), SELECT_BY_SUMMARY_SQL, (f"%{summary}%",))
         except Exception as e:
             logging.error(f"DB Error: {str(e)}")
             return []
     
     def get_events_by_date(self, date: str) -> list:
         try:
-            query = """
-                SELECT * FROM agent_events 
-                WHERE DATE(start_time AT TIME ZONE 'Europe/Rome') = %s
-            """
-            with self.conn.cursor() as cur:
-                cur.execute(query, (date,))
-                return cur.fetchall()
+            return self._fetch_cached(('date', date), SELECT_BY_DATE_SQL, (date,))
+        except Exception as e:
+            logging.error(f"DB Error: {str(e)}")
+            return []
+
+    def get_events_by_date_time_summary(self, date: str, time_prefix: str = "", summary: str = "") -> list:
+        """Eventi di una data filtrati per ora e titolo, con orari già formattati (start_hhmm, start_iso)."""
+        try:
+            return self._fetch_cached(('date_time_summary', date, time_prefix, summary), SELECT_BY_DATE_TIME_SUMMARY_SQL, (
+                date,
+                f"{_escape_like(time_prefix)}%",
+                f"%{_escape_like(summary)}%"
+            ))
         except Exception as e:
             logging.error(f"DB Error: {str(e)}")
             return []
         
     def _init_db(self):
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS agent_events (
                     id SERIAL PRIMARY KEY,
@@ -68,64 +200,77 @@ class Database:
                     created_at TIMESTAMPTZ DEFAULT NOW()
                 )
             """)
-            self.conn.commit()
+            # Indice per le ricerche per data (stessa espressione delle query)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_events_start_date_rome
+                ON agent_events ((DATE(start_time AT TIME ZONE 'Europe/Rome')))
+            """)
+        # Indice per le ricerche per titolo (ILIKE '%...%'): richiede pg_trgm, che può
+        # non essere installabile; è solo un'ottimizzazione, quindi un errore non blocca l'avvio
+        try:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_events_summary_trgm
+                    ON agent_events USING gin (summary gin_trgm_ops)
+                """)
+        except Exception as e:
+            logging.warning(f"Creazione indice trigram non riuscita: {str(e)}")
     
     def upsert_event(self, event_data: dict) -> bool:
+        logging.info(f"Tentativo di salvataggio evento: {event_data}")
+        return self.bulk_upsert_events([event_data])
+    
+    def bulk_upsert_events(self, events: list) -> bool:
+        """Salva più eventi in un solo round-trip: executemany in pipeline, COPY per grandi volumi."""
+        if not events:
+            return True
         try:
-            logging.info(f"Tentativo di salvataggio evento: {event_data}")
-            query = sql.SQL("""
-                INSERT INTO agent_events (event_id, summary, start_time, end_time)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (event_id) DO UPDATE SET
-                    summary = EXCLUDED.summary,
-                    start_time = EXCLUDED.start_time,
-                    end_time = EXCLUDED.end_time
-            """)
-            with self.conn.cursor() as cur:
-                cur.execute(query, (
-                    event_data['event_id'],
-                    event_data['summary'],
-                    event_data['start_time'],
-                    event_data['end_time']
-                ))
-                self.conn.commit()
-                logging.info("✅ Evento salvato nel database")
-                return True
+            rows = [(e['event_id'], e['summary'], e['start_time'], e['end_time']) for e in events]
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                if len(rows) > COPY_THRESHOLD:
+                    cur.execute(CREATE_TMP_EVENTS_SQL)
+                    with cur.copy(COPY_TMP_EVENTS_SQL) as copy:
+                        for ordinal, row in enumerate(rows):
+                            copy.write_row((*row, ordinal))
+                    cur.execute(UPSERT_FROM_TMP_SQL)
+                else:
+                    # psycopg3 esegue executemany in pipeline: un solo round-trip
+                    cur.executemany(UPSERT_SQL, rows)
+            self._invalidate_reads()
+            logging.info(f"✅ {len(rows)} eventi salvati nel database")
+            return True
         except Exception as e:
             logging.error(f"❌ Errore DB: {str(e)}")
-            self.conn.rollback()
             return False
     
     def delete_event(self, event_id: str) -> bool:
         try:
-            query = "DELETE FROM agent_events WHERE event_id = %s"
-            with self.conn.cursor() as cur:
-                cur.execute(query, (event_id,))
-                self.conn.commit()
-                return cur.rowcount > 0
+            with self.pool.connection() as conn:
+                deleted = conn.execute(DELETE_SQL, (event_id,), prepare=True).rowcount
+            self._invalidate_reads()
+            return deleted > 0
         except Exception as e:
             logging.error(f"DB Error: {str(e)}")
             return False
     
-    def get_events(self) -> list:
+    def delete_events(self, event_ids: list) -> int:
+        """Elimina più eventi con una sola query; restituisce le righe eliminate."""
+        if not event_ids:
+            return 0
         try:
-            query = "SELECT * FROM agent_events ORDER BY start_time"
-            with self.conn.cursor() as cur:
-                cur.execute(query)
-                return cur.fetchall()
+            with self.pool.connection() as conn:
+                deleted = conn.execute(DELETE_MANY_SQL, (list(event_ids),), prepare=True).rowcount
+            self._invalidate_reads()
+            return deleted
         except Exception as e:
             logging.error(f"DB Error: {str(e)}")
-            return []
-
-    def get_events_by_date(self, date: str) -> list:
+            return 0
+    
+    def get_events(self) -> list:
         try:
-            query = """
-                SELECT * FROM agent_events 
-                WHERE DATE(start_time) = %s
-            """
-            with self.conn.cursor() as cur:
-                cur.execute(query, (date,))
-                return cur.fetchall()
+            with self.read_pool.connection() as conn:
+                return conn.execute(SELECT_ALL_SQL, prepare=True).fetchall()
         except Exception as e:
             logging.error(f"DB Error: {str(e)}")
-        return []            
\ No newline at end of file
+            return []
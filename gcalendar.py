@@ -1,35 +1,34 @@
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-import os
+from google_clients import CALENDAR_SCOPE, get_service, get_http
+from googleapiclient.errors import HttpError
+from typing import ClassVar, Optional
 import logging
-import json
+import threading
 
-logging.basicConfig(level=logging.INFO)
+# Evento già rimosso da Google (404 non trovato, 410 eliminato)
+GONE_STATUSES = (404, 410)
 
-def get_credentials_path():
-    if os.getenv('ENV') == 'prod':
-        return '/etc/secrets/credentials.json'
-    else:
-        return 'credentials/credentials.json'
+# Limite consigliato di chiamate per singola richiesta batch dell'API Calendar
+BATCH_SIZE = 50
 
 class GoogleCalendar:
+    _instance: ClassVar[Optional["GoogleCalendar"]] = None
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+    
+    @classmethod
+    def get(cls) -> "GoogleCalendar":
+        """Istanza condivisa dal processo, creata al primo utilizzo."""
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+    
     def __init__(self):
         self.service = self._authenticate()
     
     def _authenticate(self):
         try:
-            with open(get_credentials_path(), 'r') as token:
-                creds_info = json.load(token)
-            creds = Credentials.from_authorized_user_info(creds_info)
-            
-            if not creds.valid:
-                if creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    raise Exception("Credenziali non valide")
-            
-            return build('calendar', 'v3', credentials=creds)
+            return get_service('calendar', 'v3', (CALENDAR_SCOPE,))
         except Exception as e:
             logging.error(f"Errore autenticazione Calendar: {str(e)}")
             raise
@@ -43,7 +42,7 @@ class GoogleCalendar:
         return self.service.events().insert(
             calendarId='primary',
             body=event
-        ).execute()
+        ).execute(http=get_http())
     
     def update_event(self, event_id: str, summary: str, start: str, end: str) -> dict:
         event = {
@@ -55,18 +54,55 @@ class GoogleCalendar:
             calendarId='primary',
             eventId=event_id,
             body=event
-        ).execute()
+        ).execute(http=get_http())
     
     def delete_event(self, event_id: str) -> None:
         self.service.events().delete(
             calendarId='primary',
             eventId=event_id
-        ).execute()
+        ).execute(http=get_http())
     
-    def list_events(self, max_results=10) -> list:
-        return self.service.events().list(
+    def delete_events(self, event_ids: list) -> list:
+        """Elimina più eventi con richieste batch; restituisce gli ID eliminati o già assenti."""
+        deleted = []
+        
+        def callback(request_id, response, exception):
+            if isinstance(exception, HttpError) and exception.resp.status in GONE_STATUSES:
+                # Già assente dal calendario: va comunque tolto anche dal DB
+                deleted.append(request_id)
+            elif exception is not None:
+                logging.error(f"Errore eliminazione evento {request_id}: {str(exception)}")
+            else:
+                deleted.append(request_id)
+        
+        for i in range(0, len(event_ids), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for event_id in event_ids[i:i + BATCH_SIZE]:
+                batch.add(
+                    self.service.events().delete(calendarId='primary', eventId=event_id),
+                    request_id=event_id
+                )
+            batch.execute(http=get_http())
+        return deleted
+    
+    def list_events_page(self, page_size=50, time_min=None, page_token=None) -> tuple:
+        """Una pagina di eventi: restituisce (eventi, token della pagina successiva o None)."""
+        response = self.service.events().list(
             calendarId='primary',
-            maxResults=max_results,
+            maxResults=page_size,
             singleEvents=True,
-            orderBy='startTime'
-        ).execute().get('items', [])
\ No newline at end of file
+            orderBy='startTime',
+            pageToken=page_token,
+            timeMin=time_min,
+            # Solo i campi usati: risposta molto più piccola da scaricare e decodificare
+            fields='items(id,summary,start,end),nextPageToken'
+        ).execute(http=get_http())
+        return response.get('items', []), response.get('nextPageToken')
+    
+    def iter_events(self, page_size=50, time_min=None, page_token=None):
+        """Scorre tutti gli eventi pagina per pagina, senza troncare a max_results."""
+        while True:
+            items, page_token = self.list_events_page(page_size, time_min, page_token)
+            yield from items
+            if page_token is None:
+                return
@@ -1,64 +1,108 @@
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
+from google_clients import GMAIL_SEND_SCOPE, get_credentials
 from email.mime.text import MIMEText
+import aiohttp
+import asyncio
 import base64
-import json
-import os
+import orjson
 import logging
+import threading
+from typing import ClassVar, Optional
 
-logging.basicConfig(level=logging.INFO)
+SCOPES = (GMAIL_SEND_SCOPE,)
 
-def get_credentials_path():
-    """Restituisce il percorso corretto per le credenziali."""
-    if os.getenv('ENV') == 'prod':
-        # Modalità produzione: usa il percorso di Render
-        return '/etc/secrets/credentials.json'
-    else:
-        # Modalità sviluppo: usa il percorso locale
-        return 'credentials/credentials.json'
+SEND_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/messages/send'
+
+SENDER = 'kaolay@gmail.com'
+
+# Messaggio text/plain precompilato: evita la macchina di email.message per le notifiche
+TEMPLATE = (
+    b"From: " + SENDER.encode() + b"\r\n"
+    b"To: %b\r\n"
+    b"Subject: %b\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: 8bit\r\n"
+    b"\r\n"
+    b"%b"
+)
+
+def _build_message(to: str, subject: str, body: str) -> bytes:
+    """Messaggio RFC 822 pronto per la codifica base64."""
+    headers = to + subject
+    if not headers.isascii() or '\r' in headers or '\n' in headers:
+        # Header non ASCII o su più righe: servono la codifica RFC 2047 di MIMEText
+        message = MIMEText(body)
+        message['to'] = to
+        message['from'] = SENDER
+        message['subject'] = subject
+        return message.as_bytes()
+    return TEMPLATE % (to.encode(), subject.encode(), body.encode())
 
 class GmailService:
+    _instance: ClassVar[Optional["GmailService"]] = None
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+    
+    @classmethod
+    def get(cls) -> "GmailService":
+        """Unico GmailService del processo: credenziali e sessione HTTP condivise."""
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+    
     def __init__(self):
-        self.service = self._authenticate()
+        self._authenticate()
+        self._session = None
     
     def _authenticate(self):
         """Autentica l'utente con Google OAuth."""
-        creds_path = get_credentials_path()
         try:
-            with open(creds_path, 'r') as token:
-                creds_info = json.load(token)
-            creds = Credentials.from_authorized_user_info(creds_info, scopes=['https://www.googleapis.com/auth/gmail.send'])
-            
-            if not creds.valid:
-                if creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    raise Exception("Credenziali non valide")
-            
-            return build('gmail', 'v1', credentials=creds)
+            return get_credentials(SCOPES)
         except Exception as e:
             logging.error(f"Errore autenticazione Gmail: {str(e)}")
             raise
     
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Sessione HTTP condivisa (connessioni riusate), creata dentro l'event loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=30),
+                # orjson per il corpo JSON delle richieste (aiohttp vuole una str)
+                json_serialize=lambda obj: orjson.dumps(obj).decode()
+            )
+        return self._session
+    
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+    
     async def send_email(self, to: str, subject: str, body: str) -> None:
         """Invia un'email tramite Gmail API."""
         try:
-            message = MIMEText(body)
-            message['to'] = to
-            message['from'] = 'kaolay@gmail.com'
-            message['subject'] = subject
-            raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+            raw = base64.urlsafe_b64encode(_build_message(to, subject, body)).decode('ascii')
             
             logging.info(f"Invio email a {to}")
-            self.service.users().messages().send(
-                userId='me',
-                body={'raw': raw}
-            ).execute()
+            # Un eventuale refresh del token è bloccante: va in un thread
+            creds = await asyncio.to_thread(get_credentials, SCOPES)
+            async with self._get_session().post(
+                SEND_URL,
+                headers={'Authorization': f'Bearer {creds.token}'},
+                json={'raw': raw}
+            ) as response:
+                if response.status >= 400:
+                    raise Exception(f"HTTP {response.status}: {await response.text()}")
             logging.info("✅ Email inviata con successo")
         except Exception as e:
             logging.error(f"❌ Errore invio email: {str(e)}")
             # Change this line:
             # raise
             # To this:
-            raise Exception(f"Errore invio email: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Errore invio email: {str(e)}")
+    
+    async def send_emails(self, messages: list) -> list:
+        """Invia più email in parallelo; ogni messaggio è un dict con to, subject, body."""
+        return await asyncio.gather(
+            *(self.send_email(**m) for m in messages),
+            return_exceptions=True
+        )
@@ -0,0 +1,145 @@
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from google.auth import _helpers
+from datetime import datetime, timezone
+import google_auth_httplib2
+import httplib2
+import functools
+import orjson
+import logging
+import os
+import stat
+import threading
+
+CALENDAR_SCOPE = 'https://www.googleapis.com/auth/calendar'
+GMAIL_SEND_SCOPE = 'https://www.googleapis.com/auth/gmail.send'
+
+# Scope richiesti dal flusso OAuth: un solo token per Calendar e Gmail
+SCOPES = (CALENDAR_SCOPE, GMAIL_SEND_SCOPE)
+
+def get_credentials_path():
+    """Restituisce il percorso corretto per le credenziali."""
+    if os.getenv('ENV') == 'prod':
+        # Modalità produzione: usa il percorso di Render
+        return '/etc/secrets/credentials.json'
+    else:
+        # Modalità sviluppo: usa il percorso locale
+        return 'credentials/credentials.json'
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Sostituisce il file in modo atomico mantenendone i permessi (0600 se nuovo)."""
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o600
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    # Un .tmp rimasto da un tentativo precedente conserverebbe i suoi permessi
+    os.chmod(tmp_path, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Contenuto del file credenziali già letto, con il relativo mtime
+_creds_info_cache = {'mtime': None, 'info': None}
+
+def _load_creds_info() -> dict:
+    """Legge il file delle credenziali solo se è cambiato dall'ultima lettura."""
+    path = get_credentials_path()
+    mtime = os.stat(path).st_mtime
+    if _creds_info_cache['mtime'] != mtime:
+        with open(path, 'rb') as token:
+            _creds_info_cache['info'] = orjson.loads(token.read())
+        _creds_info_cache['mtime'] = mtime
+    return _creds_info_cache['info']
+
+# Secondi prima della scadenza entro cui il token viene rinnovato. Deve superare la soglia
+# di google-auth (creds.valid diventa False prima): altrimenti è AuthorizedHttp a fare il
+# refresh in ogni thread, senza lock e senza salvare il token
+REFRESH_MARGIN = _helpers.REFRESH_THRESHOLD.total_seconds() + 60
+
+# Unico oggetto Credentials per Calendar e Gmail: un solo parse e un solo refresh
+_CREDS_CACHE = {'creds': None}
+_creds_lock = threading.Lock()
+
+def _needs_refresh(creds: Credentials) -> bool:
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    # expiry di google-auth è UTC senza timezone
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (creds.expiry - now).total_seconds() < REFRESH_MARGIN
+
+def _save_token(creds: Credentials) -> None:
+    """Aggiorna token e scadenza nel file credenziali con una scrittura atomica."""
+    path = get_credentials_path()
+    info = dict(_load_creds_info())
+    # Solo token/expiry: gli scope del file restano quelli originali
+    info['token'] = creds.token
+    info['expiry'] = creds.expiry.isoformat() + 'Z' if creds.expiry else None
+    try:
+        atomic_write(path, orjson.dumps(info))
+    except OSError as e:
+        # In produzione il file è in un volume di sola lettura: il token resta in memoria
+        logging.warning(f"Impossibile salvare il token aggiornato: {str(e)}")
+
+def get_credentials(scopes: tuple = None) -> Credentials:
+    """Credenziali in memoria, rinnovate solo quando sono vicine alla scadenza."""
+    creds = _CREDS_CACHE['creds']
+    if creds is None or _needs_refresh(creds):
+        with _creds_lock:
+            # Un altro thread potrebbe averle già rinnovate
+            creds = _CREDS_CACHE['creds']
+            if creds is None:
+                # Scope del file: il token vale per tutti i servizi che li condividono
+                creds = Credentials.from_authorized_user_info(_load_creds_info())
+            if _needs_refresh(creds) and not creds.refresh_token:
+                # Non rinnovabili: ricarica dal file, che potrebbe essere stato rigenerato
+                creds = Credentials.from_authorized_user_info(_load_creds_info())
+            if _needs_refresh(creds):
+                if not creds.refresh_token:
+                    raise Exception("Credenziali non valide")
+                creds.refresh(Request())
+                _save_token(creds)
+            _CREDS_CACHE['creds'] = creds
+    if scopes and creds.scopes and not creds.has_scopes(scopes):
+        raise Exception(f"Scope mancanti nelle credenziali: {', '.join(scopes)}")
+    return creds
+
+# Timeout (secondi) delle richieste HTTP verso le API Google
+HTTP_TIMEOUT = 30
+
+# Un AuthorizedHttp per thread: httplib2 non è thread-safe, ma riusa la connessione TLS
+_local = threading.local()
+
+def get_http() -> google_auth_httplib2.AuthorizedHttp:
+    """Trasporto HTTP autorizzato e persistente del thread corrente, da passare a execute(http=...)."""
+    creds = get_credentials()
+    http = getattr(_local, 'http', None)
+    if http is None or http.credentials is not creds:
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        _local.http = http
+    return http
+
+class _ThreadLocalHttpRequest(HttpRequest):
+    """Richiesta che, senza http esplicito, usa il trasporto del thread corrente e non quello del service."""
+    def execute(self, http=None, num_retries=0):
+        return super().execute(http=http or get_http(), num_retries=num_retries)
+
+@functools.lru_cache(maxsize=None)
+def get_service(api: str, version: str, scopes: tuple = None):
+    """Service Google condiviso da tutto il processo; le richieste passano da get_http()."""
+    creds = get_credentials(scopes)
+    # static_discovery usa il documento incluso nella libreria: nessun download
+    # Il service è condiviso tra i thread di asyncio.to_thread: nessuna richiesta
+    # deve passare dall'unico httplib2.Http interno, che non è thread-safe
+    return build(
+        api, version,
+        credentials=creds,
+        requestBuilder=_ThreadLocalHttpRequest,
+        cache_discovery=False,
+        static_discovery=True
+    )